@@ -1,9 +1,12 @@
 # import internal modules
-import json
+import asyncio
+import re
+import shelve
 
 # import external modules
-import requests
-from bs4 import BeautifulSoup
+import aiohttp
+import lxml.html
+import orjson
 
 
 
@@ -11,40 +14,103 @@ from bs4 import BeautifulSoup
 """
 
 
-def extract_cac(provider_name:str):
+HIDDEN_FIELD_ID = 'ctl00_ContentPlaceHolder1_HiddenField1'
+HIDDEN_ID_PATTERN = re.compile(rb'id="' + HIDDEN_FIELD_ID.encode() + rb'"[^>]*value="([^"]+)"')
+
+AURA_ORIGIN = 'https://azcarecheck.azdhs.gov'
+AURA_URL = AURA_ORIGIN + '/s/sfsites/aura?r=1&aura.ApexAction.execute=2'
+# %s is the json encoded facility id
+AURA_MESSAGE = '{"actions":[{"id":"79;a","descriptor":"aura://ApexActionController/ACTION$execute","callingDescriptor":"UNKNOWN","params":{"namespace":"","classname":"AZCCFacilityDetailsTabController","method":"getFacilityDetails","params":{"facilityId":%s},"cacheable":true,"isContinuation":false}}]}'
+AURA_CONTEXT = '{"mode":"PROD","fwuid":"VFJhRGxfRlFsN29ySGg2SXFsaUZsQTFLcUUxeUY3ZVB6dE9hR0VheDVpb2cxMy4zMzU1NDQzMi4yNTE2NTgyNA","app":"siteforce:communityApp","loaded":{"APPLICATION@markup://siteforce:communityApp":"1411_cmG25dptuXHlZVEVTc27wQ"},"dn":[],"globals":{},"uad":true}'
+FACILITY_PAGE = '/s/facility-details?facilityId={facility_id}&programType=Health%20Care%20Facilties'
+
+# provider name -> facility id, kept for the life of the process
+facility_ids = {}
+FACILITY_ID_CACHE = 'data/cac_cache'
+
+HEADERS = {
+    "Connection" : "keep-alive",
+    "User-Agent" : "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/110.0.0.0 Safari/537.36"
+}
+
+
+def parse_hidden_id(content:bytes):
+    """ Parses the search page and returns the value of the hidden facility id field """
+
+    return lxml.html.fromstring(content).get_element_by_id(HIDDEN_FIELD_ID).get('value')
+
+
+async def fetch(session:aiohttp.ClientSession, method:str, url:str, retries:int=3, backoff_factor:float=0.3, **kwargs):
+    """ Sends a request over the shared session and returns the raw response body.
+        Connection errors are retried with exponential backoff, so a dropped keep-alive
+        connection does not fail the lookup.
+
+        arguments:
+            session : the aiohttp session shared by all lookups
+            method : the http method, e.g 'GET' or 'POST'
+            url : the url to request
+            retries : the number of times to retry on a connection error
+            backoff_factor : the base delay in seconds between retries
+
+        returns:
+            the response body as bytes
+    """
+
+    for attempt in range(retries + 1):
+        try:
+            async with session.request(method, url, **kwargs) as response:
+                return await response.read()
+        except aiohttp.ClientConnectionError:
+            if attempt == retries: raise
+            await asyncio.sleep(backoff_factor * 2 ** attempt)
+
+
+async def extract_cac(session:aiohttp.ClientSession, sem:asyncio.Semaphore, provider_name:str, cache=facility_ids):
     """ Extracts Cheif Administrator Contact of an health care facility, provided it's name.
-        This method uses the requests library to send a post requests. This post requests 
+        This method uses a shared aiohttp session to send a post requests. This post requests
         requires a hidden user id available in the form data. A future update would be to use
         browser automation to automatically fetch the user id.
 
         arguments:
+            session : the aiohttp session shared by all lookups
+            sem : semaphore bounding the number of lookups in flight
             provider_name : the name of the health care facility
+            cache : mapping of provider name to facility id, filled as facilities are looked up
 
         returns:
             cheif_administrator : The name of the cheif administrator for the facility
     """
 
-    # Fecth facility id
-    url = f"https://hsapps.azdhs.gov/ls/sod/Provider.aspx?ProviderName={provider_name}"
-    response = requests.get(url)
-    soup = BeautifulSoup(response.text)
-    hidden_id = soup.find(id="ctl00_ContentPlaceHolder1_HiddenField1").get('value')
-
-    # fetch facility details
-    url = 'https://azcarecheck.azdhs.gov/s/sfsites/aura?r=1&aura.ApexAction.execute=2'
-    form_data = {
-        'message' : '{"actions":[{"id":"79;a","descriptor":"aura://ApexActionController/ACTION$execute","callingDescriptor":"UNKNOWN","params":{"namespace":"","classname":"AZCCFacilityDetailsTabController","method":"getFacilityDetails","params":{"facilityId":"' + hidden_id + '"},"cacheable":true,"isContinuation":false}}]}',
-        'aura.context' : '{"mode":"PROD","fwuid":"VFJhRGxfRlFsN29ySGg2SXFsaUZsQTFLcUUxeUY3ZVB6dE9hR0VheDVpb2cxMy4zMzU1NDQzMi4yNTE2NTgyNA","app":"siteforce:communityApp","loaded":{"APPLICATION@markup://siteforce:communityApp":"1411_cmG25dptuXHlZVEVTc27wQ"},"dn":[],"globals":{},"uad":true}',
-        'aura.pageURI' : f'/s/facility-details?facilityId={hidden_id}&programType=Health%20Care%20Facilties',
-        'aura.token' : 'null'
-    }
-    headers = {
-        'Origin': 'https://azcarecheck.azdhs.gov',
-        "Referer" : f"https://azcarecheck.azdhs.gov/s/facility-details?facilityId={hidden_id}&programType=Health%20Care%20Facilties",
-        "User-Agent" : "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/110.0.0.0 Safari/537.36"
-    }
-    response = requests.post(url, headers=headers, data=form_data)
-    response_json = json.loads(response.text)
+    async with sem:
+        # Fecth facility id, unless this provider has been looked up before
+        hidden_id = cache.get(provider_name)
+        if hidden_id is None:
+            url = f"https://hsapps.azdhs.gov/ls/sod/Provider.aspx?ProviderName={provider_name}"
+            content = await fetch(session, 'GET', url)
+            match = HIDDEN_ID_PATTERN.search(content)
+            if match:
+                hidden_id = match.group(1).decode()
+            else:
+                # attributes are in an unexpected order, fall back to parsing the page with lxml
+                # off the event loop so the other lookups keep running
+                hidden_id = await asyncio.to_thread(parse_hidden_id, content)
+            cache[provider_name] = hidden_id
+
+        # fetch facility details
+        facility_page = FACILITY_PAGE.format(facility_id=hidden_id)
+        form_data = {
+            'message' : AURA_MESSAGE % orjson.dumps(hidden_id).decode(),
+            'aura.context' : AURA_CONTEXT,
+            'aura.pageURI' : facility_page,
+            'aura.token' : 'null'
+        }
+        headers = {
+            'Origin': AURA_ORIGIN,
+            "Referer" : AURA_ORIGIN + facility_page
+        }
+        content = await fetch(session, 'POST', AURA_URL, headers=headers, data=form_data)
+
+    response_json = orjson.loads(content)
     cheif_administrator = response_json['actions'][0]['returnValue']['returnValue']['chiefAdministrativeOfficer']
     names = cheif_administrator.split()
     first_name, last_name = names[0], names[-1]
@@ -52,5 +118,54 @@ def extract_cac(provider_name:str):
     return [first_name, last_name]
 
 
+async def extract_cac_many(provider_names:list, concurrency:int=20):
+    """ Extracts the Cheif Administrator Contact of many health care facilities concurrently.
+        All lookups share one keep-alive session, and facility ids are cached on disk between runs.
+
+        arguments:
+            provider_names : the names of the health care facilities
+            concurrency : the maximum number of lookups running at the same time
+
+        returns:
+            a list of [first_name, last_name] in the same order as provider_names,
+            None for facilities that could not be looked up
+    """
+
+    # chain facilities repeat within a batch, look each name up once
+    unique_names = list(dict.fromkeys(provider_names))
+
+    sem = asyncio.Semaphore(concurrency)
+    connector = aiohttp.TCPConnector(limit=50, limit_per_host=32, keepalive_timeout=30)
+    with shelve.open(FACILITY_ID_CACHE) as cache:
+        async with aiohttp.ClientSession(connector=connector, headers=HEADERS) as session:
+            # one facility that is not found should not throw away the rest of the batch
+            results = await asyncio.gather(*[extract_cac(session, sem, name, cache) for name in unique_names], return_exceptions=True)
+
+    contacts = {}
+    for name, result in zip(unique_names, results):
+        if isinstance(result, Exception):
+            print(f"✗ Could not extract the chief administrator of {name}: {result!r}")
+            result = None
+        contacts[name] = result
+    return [contacts[name] for name in provider_names]
+
+
+def extract_cac_batch(provider_names:list, workers:int=20):
+    """ Synchronous entry point for extract_cac_many, for callers that are not running an event loop,
+        e.g extract_cac_batch(df['Name'].tolist())
+
+        arguments:
+            provider_names : the names of the health care facilities
+            workers : the maximum number of lookups running at the same time
+
+        returns:
+            a list of [first_name, last_name] in the same order as provider_names,
+            None for facilities that could not be looked up
+    """
+
+    return asyncio.run(extract_cac_many(provider_names, concurrency=workers))
+
+
 if __name__ == "__main__":
-    extract_cac()
\ No newline at end of file
+    import sys
+    print(extract_cac_batch(sys.argv[1:]))
@@ -1,11 +1,23 @@
 # import internal modules
+import io
 import os
+import json
 import time
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 # import external modules
 import pandas as pd
 from dotenv import load_dotenv
 from simple_salesforce import Salesforce
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
+
+# import project modules
+from new_fields import SALESFORCE_INBUILT_FIELDS, column_field_spec, load_fields_metadata
+from salesforce import to_records
+from transient_errors import is_transient
 
 
 """
@@ -14,6 +26,99 @@ Covers single accounts, bulk imports, and error handling
 """
 
 
+load_dotenv()
+CONSUMER_KEY = os.getenv('CONSUMER_KEY')
+CONSUMER_SECRET = os.getenv('CONSUMER_SECRET')
+DOMAIN = os.getenv('DOMAIN')
+
+PROVIDER_INFO_URL = 'https://data.cms.gov/provider-data/sites/default/files/resources/e923f267504f72a3b10c2daa39efed8a_1757685912/NH_ProviderInfo_Sep2025.csv'
+
+# identifiers keep their leading zeros and are never used as numbers,
+# State is filtered on and only has a few dozen distinct values
+PROVIDER_INFO_DTYPES = {
+    'CMS Certification Number (CCN)': 'string',
+    'ZIP Code': 'string',
+    'Telephone Number': 'string',
+    'State': 'category',
+}
+
+
+class TokenBucket:
+    """Token bucket rate limiter. Allows bursts of up to `capacity` requests
+        and refills at `refill_rate` tokens per second.
+    """
+    
+    def __init__(self, capacity, refill_rate):
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def acquire(self):
+        """Block until a token is available, then take it"""
+        with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.refill_rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                time.sleep((1 - self.tokens) / self.refill_rate)
+
+
+# every chunk is sent with the same query shape
+EXISTING_ACCOUNTS_QUERY = "SELECT Id, CCN__c FROM Account WHERE CCN__c IN ({})"
+
+# below this many new accounts, composite batch requests are used instead of a bulk job
+COMPOSITE_THRESHOLD = 200
+COMPOSITE_BATCH_SIZE = 25
+
+# shared by every Salesforce call in this module
+rate_limiter = TokenBucket(capacity=25, refill_rate=25)
+
+
+retry_transient = retry(
+    retry=retry_if_exception(is_transient),
+    wait=wait_exponential(min=1, max=30),
+    stop=stop_after_attempt(5),
+    reraise=True
+)
+
+
+@retry_transient
+def query_all(sf, query):
+    """Run a SOQL query through the rate limiter, retrying transient failures"""
+    rate_limiter.acquire()
+    return sf.query_all(query)
+
+
+@retry_transient
+def create_account(sf, account_data):
+    """Create one account through the rate limiter, retrying transient failures"""
+    rate_limiter.acquire()
+    return sf.Account.create(account_data)
+
+
+def load_provider_info(url=PROVIDER_INFO_URL):
+    """Load the CMS provider info csv, parsing only the columns that have a Salesforce field.
+        The first download is cached next to the metadata as parquet and read from there afterwards.
+        CMS publishes each release under a new file name, so a new url gets a new cache file.
+    """
+    
+    with open('data/metadata.json') as file:
+        columns = list(json.load(file)['columns']['fields'])
+    
+    cache = os.path.join('data', os.path.splitext(os.path.basename(url))[0] + '.parquet')
+    if os.path.exists(cache):
+        return pd.read_parquet(cache, columns=columns)
+    
+    df = pd.read_csv(url, usecols=columns, dtype=PROVIDER_INFO_DTYPES)
+    df.to_parquet(cache, compression='zstd')
+    return df
+
+
 def connect_to_salesforce(consumer_key, consumer_secret, domain):
     """Connect to Salesforce"""
     try:
@@ -29,26 +134,60 @@ def connect_to_salesforce(consumer_key, consumer_secret, domain):
         return None
 
 
-def add_account(sf, account_data):
-    """Add account only if it doesn't already exist
+def soql_quote(value):
+    """Quote a value as a SOQL string literal, escaping backslashes and quotes"""
+    return "'" + str(value).replace('\\', '\\\\').replace("'", "\\'") + "'"
+
+
+def get_existing_accounts(sf, ccns, chunk_size=200, bulk_threshold=5000):
+    """Look up which CCNs already have an account, a couple hundred CCNs per query.
+        Above `bulk_threshold` CCNs, every account with a CCN is pulled in one Bulk API job instead,
+        which returns csv and is far cheaper to parse than thousands of json records.
+
+        Returns:
+            dict: CCN__c -> Account Id for every CCN that already exists
     """
     
-    account_name, account_ccn = account_data['Name'], account_data['CCN__c']
+    ccns = list(dict.fromkeys(pd.Series(ccns).dropna()))
+    existing = {}
+    
+    if len(ccns) > bulk_threshold:
+        rate_limiter.acquire()
+        pages = sf.bulk2.Account.query("SELECT Id, CCN__c FROM Account WHERE CCN__c != null")
+        wanted = set(ccns)
+        for page in pages:
+            records = pd.read_csv(io.StringIO(page), dtype={'Id': 'string', 'CCN__c': 'string'})
+            existing.update({ccn: id_ for ccn, id_ in zip(records['CCN__c'], records['Id']) if ccn in wanted})
+        return existing
     
-    # Check if account exists
+    for start in range(0, len(ccns), chunk_size):
+        chunk = ccns[start:start + chunk_size]
+        result = query_all(sf, EXISTING_ACCOUNTS_QUERY.format(", ".join(map(soql_quote, chunk))))
+        existing.update({record['CCN__c']: record['Id'] for record in result['records']})
+    
+    return existing
+
 
-    query = f"SELECT Id FROM Account WHERE CCN_c = '{account_ccn}' LIMIT 1"
+def add_account(sf, account_data, existing=None):
+    """Add account only if it doesn't already exist
+    
+        Args:
+            existing: CCN -> Id map from get_existing_accounts, queried for this account if not given
+    """
+    
+    account_name, account_ccn = account_data['Name'], account_data['CCN__c']
     
     try:
-        result = sf.query(query)
+        # Check if account exists
+        if existing is None:
+            existing = get_existing_accounts(sf, [account_ccn])
         
-        if result['totalSize'] > 0:
-            existing = result['records'][0]
-            print(f"  ⊗ Account '{account_name}' already exists (ID: {existing['Id']})")
-            return {'success': False, 'message': 'Duplicate', 'id': existing['Id']}
+        if account_ccn in existing:
+            print(f"  ⊗ Account '{account_name}' already exists (ID: {existing[account_ccn]})")
+            return {'success': False, 'message': 'Duplicate', 'id': existing[account_ccn]}
         
         # Create new account
-        new_account = sf.Account.create(account_data)
+        new_account = create_account(sf, account_data)
         print(f"  ✓ Created new account: {account_name} (ID: {new_account['id']})")
         return {'success': True, 'id': new_account['id'], 'created': True}
         
@@ -57,45 +196,78 @@ def add_account(sf, account_data):
         return {'success': False, 'error': str(e)}
 
 
+@retry_transient
+def create_accounts_composite(sf, records):
+    """Create up to 25 accounts in a single Composite Batch request
+    
+        Returns:
+            list: one result per record, in the same shape as the Bulk API results
+    """
+    rate_limiter.acquire()
+    response = sf.restful('composite/batch', method='POST', json={
+        'batchRequests': [
+            {'method': 'POST', 'url': f'v{sf.sf_version}/sobjects/Account', 'richInput': record}
+            for record in records
+        ]
+    })
+    
+    results = []
+    for item in response['results']:
+        if item['statusCode'] == 201:
+            results.append({'success': True, 'created': True, 'id': item['result']['id'], 'errors': []})
+        else:
+            results.append({'success': False, 'created': False, 'id': None, 'errors': item['result']})
+    return results
+
+
+def create_accounts_chunk(sf, records):
+    """Create one chunk of accounts, turning an error that outlasted the retries into a failed result per record,
+        so one bad chunk does not throw away the accounts the other chunks already created
+    """
+    try:
+        return create_accounts_composite(sf, records)
+    except Exception as e:
+        return [{'success': False, 'created': False, 'id': None, 'errors': [{'message': str(e)}]} for _ in records]
+
+
 def add_accounts_from_dataframe(sf, df):
-    """Import accounts from a pandas DataFrame with custom mapping
+    """Import accounts from a pandas DataFrame.
+        Accounts whose CCN already exists are skipped, not overwritten.
+        Small imports are sent as concurrent Composite Batch requests of 25 accounts,
+        larger ones as a single Bulk API job, which avoids the bulk job lifecycle for a handful of records.
     """
     
     print(f"Importing {len(df)} records...\n")
     
-    results = []
+    existing = get_existing_accounts(sf, df['CCN__c'])
+    new_df = df[~df['CCN__c'].isin(existing)]
+    print(f"  ⊗ {len(df) - len(new_df)} accounts already exist, skipping...")
     
-    for index, row in df.iterrows():
-        try:
-            # Build account data from mapping
-            account_data = {}
-            
-            # Create account
-            result = add_account(sf, account_data)
-            results.append({
-                'success': True,
-                'id': result['id'],
-                'name': account_data.get('Name', 'Unknown')
-            })
-            print(f"  [{index + 1}/{len(df)}] ✓ {account_data.get('Name', 'Unknown')}")
-            
-            time.sleep(0.1)
-            
-        except Exception as e:
-            results.append({
-                'success': False,
-                'error': str(e),
-                'name': row.get('Provider Name', 'Unknown')
-            })
-            print(f"  [{index + 1}/{len(df)}] ✗ Error: {str(e)}")
-    
-    success_count = sum(1 for r in results if r.get('success'))
-    print(f"\n✓ Created {success_count}/{len(df)} accounts")
+    # a CCN repeated in the frame is created once, the second create would fail on the unique CCN__c
+    repeated = new_df['CCN__c'].duplicated(keep='first') & new_df['CCN__c'].notna()
+    if repeated.any():
+        print(f"  ⊗ {repeated.sum()} rows repeat a CCN, skipping...")
+        new_df = new_df[~repeated]
+    
+    records = to_records(new_df)
+    if len(records) < COMPOSITE_THRESHOLD:
+        chunks = [records[i:i + COMPOSITE_BATCH_SIZE] for i in range(0, len(records), COMPOSITE_BATCH_SIZE)]
+        with ThreadPoolExecutor(max_workers=5) as executor:
+            results = [result for chunk in executor.map(partial(create_accounts_chunk, sf), chunks) for result in chunk]
+    else:
+        rate_limiter.acquire()
+        results = sf.bulk.Account.insert(records, batch_size=10000)
+    
+    outcomes = Counter('created' if r.get('success') else 'failed' for r in results)
+    print(f"\n✓ Created {outcomes['created']}/{len(new_df)} accounts")
+    if outcomes['failed']:
+        errors = Counter(error['message'] for r in results for error in r.get('errors') or [])
+        print(f"✗ {outcomes['failed']} accounts failed: {dict(errors)}")
     
     return results
 
 
-def main():
+def main(consumer_key=CONSUMER_KEY, consumer_secret=CONSUMER_SECRET, domain=DOMAIN):
     """ Creates new accounts from dataset of all nursing homes in the following states: 
         Arizona, Nevada, Utah & Colorado. First checks if such account exists, if not creates it.
 
@@ -105,14 +277,9 @@ def main():
 
     """
     
-    load_dotenv()
-    CONSUMER_KEY = os.getenv('CONSUMER_KEY')
-    CONSUMER_SECRET = os.getenv('CONSUMER_SECRET')
-    DOMAIN = os.getenv('DOMAIN')
-    
     try:
         # Connect to Salesforce
-        sf = connect_to_salesforce(CONSUMER_KEY, CONSUMER_SECRET, DOMAIN)
+        sf = connect_to_salesforce(consumer_key, consumer_secret, domain)
 
         #       Work with sql query endpoint. One state query works, many states query does not
         # query = '[SELECT * FROM 0ae91eb2-22da-5fe3-9dce-9811cdd6f1a8][WHERE State IN ("AZ", "NV", "UT", "CO")][LIMIT 2]'
@@ -121,29 +288,14 @@ def main():
         # response = requests.get(request_url, headers={'accept': 'application/json'})
         # data = response.json()
 
-        df = pd.read_csv('https://data.cms.gov/provider-data/sites/default/files/resources/e923f267504f72a3b10c2daa39efed8a_1757685912/NH_ProviderInfo_Sep2025.csv')
-        df = df[df['State'].isin(['AZ', 'NV', 'UT', 'CO'])]
+        df = load_provider_info()
+        mask = df['State'].isin(['AZ', 'NV', 'UT', 'CO'])
+        df = df.loc[mask].copy()
+        # name the columns with the same code that names the fields, so the two cannot drift
         mapped_columns = {
-            # salesforce inbuilt fields
-            'Provider Name': 'Name',
-            'Provider Address': 'BillingStreet',
-            'City/Town': 'BillingCity',
-            'State': 'BillingState',
-            'ZIP Code': 'BillingPostalCode',
-            'Telephone Number': 'Phone',
-            'Provider Type': 'Type',
-            'Ownership Type': 'Industry',
+            column: SALESFORCE_INBUILT_FIELDS.get(column) or column_field_spec(column, field_type).field_name
+            for column, field_type in load_fields_metadata().items()
         }
-        df_columns = df.columns
-
-        for column in df_columns:
-            if column == 'CMS Certification Number (CCN)':
-                mapped_columns[column] = 'CCN__c'
-            elif column == 'County/Parish':
-                mapped_columns[column] = 'County__c'
-            else:
-                mapped_columns[column] = f'{column}__c'
-            
         df.rename(columns=mapped_columns, inplace=True)
         add_accounts_from_dataframe(sf, df[:2])
     
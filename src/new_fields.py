@@ -1,22 +1,218 @@
 # import internal modules
 import os
 import time
-import json
+import logging
 import re
-import traceback
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from functools import lru_cache, partial
+from logging.handlers import MemoryHandler
+from types import MappingProxyType
+from typing import Mapping
+from urllib.parse import quote_plus
 
 
 # import external libraries
 from dotenv import load_dotenv
-from simple_salesforce import Salesforce
-from simple_salesforce.metadata import SfdcMetadataApi
+import orjson
+from tenacity import Retrying, retry_if_exception, stop_after_attempt, wait_exponential
+
+# import project modules
+from transient_errors import is_transient
 
 
 """ Programmatically create custom fields in Salesforce for Healthcare Facility data
 """
 
+logger = logging.getLogger(__name__)
+
+# the tooling composite api accepts at most 25 subrequests per call
+TOOLING_BATCH_SIZE = 25
+
+# login session kept between runs, salesforce expires it after 2 hours of inactivity by default
+SESSION_CACHE = 'data/sf_session.json'
+SESSION_TTL = 90 * 60
+
+# characters salesforce does not accept in a field name
+INVALID_FIELD_CHARS = re.compile(r'[^A-Za-z0-9_]')
+# a custom field api name: starts with a letter, no double or trailing underscores, then __c
+FIELD_NAME_PATTERN = re.compile(r'[A-Za-z](?:[A-Za-z0-9]|_(?!_))*__c')
+# longest field name salesforce allows, without the __c suffix
+MAX_FIELD_NAME_LENGTH = 40
+
+# csv columns that map onto standard Account fields, no custom field is needed for these
+SALESFORCE_INBUILT_FIELDS = MappingProxyType({
+    'Provider Name': 'Name',
+    'Provider Address': 'BillingStreet',
+    'City/Town': 'BillingCity',
+    'State': 'BillingState',
+    'ZIP Code': 'BillingPostalCode',
+    'Telephone Number': 'Phone',
+    'Provider Type': 'Type',
+    'Ownership Type': 'Industry',
+})
+
+# csv columns whose field config is not derived from the column name
+SPECIAL_FIELDS = MappingProxyType({
+    'CMS Certification Number (CCN)': MappingProxyType({
+        'object_name': 'Account',
+        'field_name': 'CCN__c',
+        'label': 'CMS Certification Number',
+        'length': 50,
+        'unique': True,
+        'external_id': True,
+        'description': 'CMS Certification Number (CCN) - unique identifier'
+    }),
+    'County/Parish': MappingProxyType({
+        'object_name': 'Account',
+        'field_name': 'County__c',
+        'label': 'County'
+    }),
+})
+
+
+# field type -> (metadata type, supported options with their defaults)
+# options are given in snake_case and sent as their camelCase metadata names
+FIELD_TYPES = {
+    'text': ('Text', {'length': 255, 'required': False, 'unique': False, 'external_id': False}),
+    # precision is the total number of digits, scale the digits right of the decimal point
+    'num': ('Number', {'precision': 18, 'scale': 10, 'required': False}),
+    'checkbox': ('Checkbox', {'default_value': False, 'required': False}),
+    'date': ('Date', {'required': False}),
+    'currency': ('Currency', {'precision': 18, 'scale': 2, 'required': False}),
+    # latitude and longitude are accessed as <name>__Latitude__s and <name>__Longitude__s
+    'location': ('Location', {'display_location_in_decimal': True, 'scale': 7, 'required': False}),
+    'picklist': ('Picklist', {'values': (), 'required': False}),
+}
+
+# options whose metadata differs from the python value, option -> (metadata name, value)
+OPTION_TRANSFORMS = {
+    'default_value': lambda value: ('defaultValue', str(value).lower()),
+    'values': lambda values: ('valueSet', {'valueSetDefinition': {
+        'sorted': False,
+        'value': [{'fullName': value, 'label': value, 'default': index == 0} for index, value in enumerate(values)]
+    }}),
+}
+
+# metadata values salesforce assumes when they are left out
+# checkbox defaultValue is not here as salesforce requires it
+SALESFORCE_DEFAULTS = {'required': False, 'unique': False, 'externalId': False}
+
+
+@lru_cache(maxsize=None)
+def metadata_template(field_type, options):
+    """
+    Build the type specific part of a field's metadata, shared by every field with the same type and options
+    
+    Args:
+        field_type: Key of FIELD_TYPES (e.g., 'text')
+        options: Sorted tuple of (option, value) pairs, see FIELD_TYPES
+        
+    Returns:
+        MappingProxyType: type, and the camelCase metadata options
+    """
+    if field_type not in FIELD_TYPES:
+        raise ValueError(f"Unknown field type: {field_type}")
+    metadata_type, defaults = FIELD_TYPES[field_type]
+    options = dict(options)
+    unsupported = options.keys() - defaults.keys()
+    if unsupported:
+        raise TypeError(f"Unsupported options for a {field_type} field: {sorted(unsupported)}")
+    
+    metadata = {'type': metadata_type}
+    for option, default in defaults.items():
+        value = options.get(option, default)
+        if option in OPTION_TRANSFORMS:
+            key, value = OPTION_TRANSFORMS[option](value)
+        else:
+            key = re.sub(r'_(\w)', lambda match: match.group(1).upper(), option)
+        # salesforce fills these in itself, no need to send them
+        if key in SALESFORCE_DEFAULTS and value == SALESFORCE_DEFAULTS[key]:
+            continue
+        metadata[key] = value
+    
+    return MappingProxyType(metadata)
+
+
+def build_field_metadata(field_type, object_name, field_name, label, description=None, **options):
+    """
+    Build the Tooling API body for a custom field
+    
+    Args:
+        field_type: Key of FIELD_TYPES (e.g., 'text')
+        object_name: Object API name (e.g., 'Account')
+        field_name: Field API name (e.g., 'CCN__c')
+        label: Field label
+        description: Optional field description
+        options: Type specific options, see FIELD_TYPES
+        
+    Returns:
+        dict: CustomField body with FullName and Metadata
+    """
+    # catch names salesforce would reject before any request is sent
+    if not FIELD_NAME_PATTERN.fullmatch(field_name) or len(field_name) - len('__c') > MAX_FIELD_NAME_LENGTH:
+        raise ValueError(f"Invalid custom field name: {field_name}")
+    
+    # lists (e.g picklist values) become tuples so the options can key the template cache
+    options = tuple(sorted((option, tuple(value) if isinstance(value, list) else value) for option, value in options.items()))
+    metadata = {'label': label, **metadata_template(field_type, options)}
+    if description:
+        metadata['description'] = description
+    
+    return {'FullName': f"{object_name}.{field_name}", 'Metadata': metadata}
+
+
+@dataclass(slots=True, frozen=True)
+class FieldSpec:
+    """A custom field to create, with the arguments of build_field_metadata"""
+    
+    field_type: str
+    object_name: str
+    field_name: str
+    label: str
+    description: str | None = None
+    options: Mapping = field(default_factory=dict)
+    
+    @classmethod
+    def from_config(cls, field_type, config):
+        """Build a spec from a config mapping, as in SPECIAL_FIELDS"""
+        options = dict(config)
+        return cls(field_type, options.pop('object_name'), options.pop('field_name'), options.pop('label'),
+                   options.pop('description', None), MappingProxyType(options))
+    
+    def to_metadata(self):
+        """Build the Tooling API body for this field"""
+        return build_field_metadata(self.field_type, self.object_name, self.field_name, self.label,
+                                    self.description, **self.options)
+
+
+def retry_with_backoff(fn, *args, attempts=5, max_delay=2):
+    """
+    Call fn(*args), retrying with exponential backoff while the error is transient.
+    Any other error is raised immediately.
+    
+    Args:
+        attempts: Maximum number of calls
+        max_delay: Longest wait in seconds between two calls
+    """
+    retrying = Retrying(
+        retry=retry_if_exception(is_transient),
+        wait=wait_exponential(multiplier=0.25, max=max_delay),
+        stop=stop_after_attempt(attempts),
+        reraise=True
+    )
+    return retrying(fn, *args)
+
+
+# session id -> the field cache of SalesforceFieldManager
+field_caches = {}
+field_cache_lock = threading.Lock()
+
+
 class SalesforceFieldManager:
-    """Manage custom field creation using Metadata API
+    """Manage custom field creation using the Tooling API
     """
     
     def __init__(self, sf):
@@ -26,14 +222,70 @@ class SalesforceFieldManager:
         Args:
             sf: simple_salesforce.Salesforce instance
         """
+        # imported here so the field config can be used without loading requests
+        from requests.adapters import HTTPAdapter
+        
         self.sf = sf
-        self.mdapi = sf.mdapi
-        print("✓ Metadata API initialized\n")
+        # keep connections alive across calls, with enough of them for concurrent requests
+        # failed connections are retried by retry_with_backoff, not by the adapter
+        adapter = HTTPAdapter(pool_connections=5, pool_maxsize=25, pool_block=True)
+        sf.session.mount('https://', adapter)
+        # object name -> names of its fields, from one query per object
+        # shared by every manager on the same session, so a new manager does not query again
+        self._field_cache: dict[str, set[str]] = field_caches.setdefault(sf.session_id, {})
+        logger.info("✓ Tooling API initialized\n")
+    
+    def invalidate(self, object_name):
+        """Drop the cached fields of an object so the next check queries them again"""
+        with field_cache_lock:
+            self._field_cache.pop(object_name, None)
+    
+    def _tooling(self, action, method='GET', payload=None):
+        """
+        Call a Tooling API endpoint, like sf.toolingexecute but encoding and decoding with orjson
+        
+        Args:
+            action: Endpoint relative to the tooling url (e.g., 'composite')
+            method: HTTP method
+            payload: Request body, sent as json
+            
+        Returns:
+            dict: Decoded response
+        """
+        data = orjson.dumps(payload) if payload is not None else None
+        response = self.sf._call_salesforce(method, self.sf.tooling_url + action, name='tooling', data=data)
+        return orjson.loads(response.content)
+    
+    def existing_fields(self, object_name):
+        """
+        Get the API names of every field on an object.
+        Queries FieldDefinition through the Tooling API, which returns only the names
+        instead of the full describe payload, and caches the result per object.
+        
+        Args:
+            object_name: Object API name (e.g., 'Account')
+            
+        Returns:
+            set: Field API names
+        """
+        # held while querying, so concurrent callers wait for the one query instead of repeating it
+        with field_cache_lock:
+            if object_name not in self._field_cache:
+                query = f"SELECT QualifiedApiName FROM FieldDefinition WHERE EntityDefinition.QualifiedApiName = '{object_name}'"
+                response = self._tooling(f"query/?q={quote_plus(query)}")
+                fields = {record['QualifiedApiName'] for record in response['records']}
+                while response.get('nextRecordsUrl'):
+                    response = self._tooling(response['nextRecordsUrl'].split('/tooling/', 1)[1])
+                    fields.update(record['QualifiedApiName'] for record in response['records'])
+                self._field_cache[object_name] = fields
+            return self._field_cache[object_name]
     
     def check_field_exists(self, object_name, field_name):
         """
         Check if a custom field already exists.
-        For some reasons, new fields created are not being returned as of now.
+        The fields of each object are queried once and cached for later checks.
+        For some reasons, new fields created are not being returned as of now,
+        so fields created by this manager are added to the cache directly.
         
         Args:
             object_name: Object API name (e.g., 'Account')
@@ -43,234 +295,176 @@ class SalesforceFieldManager:
             bool: True if field exists, False otherwise
         """
         try:
-            obj = getattr(self.sf, object_name)
-            metadata = obj.describe()
-            existing_fields = {field['name'] for field in metadata['fields']}
-            return field_name in existing_fields
+            return field_name in self.existing_fields(object_name)
             
         except Exception as e:
-            print(f"Warning: Could not check if field exists: {e}")
+            logger.warning("Warning: Could not check if field exists: %s", e)
             return False
     
-    def create_text_field(self, object_name, field_name, label, length=255, 
-                         required=False, unique=False, external_id=False, 
-                         description=None):
-        """Create a text custom field
+    def create_field(self, field_type, object_name, field_name, label, **options):
         """
+        Create a single custom field, skipping it if it already exists
         
-        full_name = f"{object_name}.{field_name}"
-        
-        # Check if exists
+        Args:
+            field_type: Key of FIELD_TYPES (e.g., 'text')
+            object_name: Object API name (e.g., 'Account')
+            field_name: Field API name (e.g., 'CCN__c')
+            label: Field label
+            options: Type specific options, see FIELD_TYPES
+            
+        Returns:
+            dict: success flag, and the error message if creation failed
+        """
         if self.check_field_exists(object_name, field_name):
-            print(f"  ⊗ Field {field_name} already exists, skipping...")
+            logger.info("  ⊗ Field %s already exists, skipping...", field_name)
             return {'success': False, 'message': 'Field already exists'}
-
-        custom_field = self.mdapi.CustomField(
-            fullName = full_name,
-            label = label,
-            type = self.mdapi.FieldType("Text"),
-            length = length,
-            required = required,
-            unique = unique,
-            externalId = external_id,
-            deploymentStatus = self.mdapi.DeploymentStatus("Deployed"),
-            sharingModel = self.mdapi.SharingModel("Read")
-        )
-        
-        if description:
-            custom_field['description'] = description
         
+        custom_field = build_field_metadata(field_type, object_name, field_name, label, **options)
+        # a single field is posted straight to the sobject endpoint, without the composite wrapper
         try:
-            self.mdapi.CustomField.create(custom_field)
-            print(f"  ✓ Created text field: {field_name}")
-            return {'success': True, 'field': field_name}   
-          
+            retry_with_backoff(self._tooling, 'sobjects/CustomField', 'POST', custom_field)
         except Exception as e:
-            print(f"  ✗ Exception creating {field_name}: {str(e)}")
-            return {'success': False, 'field': field_name, 'error': str(e)}
+            content = getattr(e, 'content', None)
+            error = self._extract_error(content) if isinstance(content, list) else str(e)
+            return {'success': False, 'field': field_name, 'error': error}
+        self._add_to_cache(custom_field['FullName'])
+        return {'success': True, 'field': field_name}
     
-    def create_number_field(self, object_name, field_name, label, precision=18, 
-                           scale=10, required=False, description=None):
-        """Create a number custom field
-            Precision represents the number of digits to the left of the decimal point.
+    def create_fields_batch(self, custom_fields, batch_size=TOOLING_BATCH_SIZE, concurrency=5, delay=2):
         """
+        Create custom fields with as few API calls as possible.
+        Each call is a Tooling API composite request of up to 25 CustomField inserts,
+        and up to `concurrency` calls are in flight at once.
         
-        full_name = f"{object_name}.{field_name}"
-        
-        if self.check_field_exists(object_name, field_name):
-            print(f"  ⊗ Field {field_name} already exists, skipping...")
-            return {'success': False, 'message': 'Field already exists'}
-        
-        custom_field = self.mdapi.CustomField(
-            fullName = full_name,
-            label = label,
-            type = self.mdapi.FieldType("Number"),
-            required = required,
-            precision = precision,
-            scale = scale,
-            deploymentStatus = self.mdapi.DeploymentStatus("Deployed"),
-            sharingModel = self.mdapi.SharingModel("Read")
-        )
-        
-        if description:
-            # this has not been confirmed to be working
-            custom_field['description'] = description
+        Args:
+            custom_fields: CustomField bodies from build_field_metadata
+            batch_size: Fields sent per composite request
+            concurrency: Maximum number of concurrent composite requests
+            delay: Longest wait in seconds before retrying a throttled call
+            
+        Returns:
+            dict: FullName -> error message for every field, None if it was created
+        """
+        batches = [custom_fields[start:start + batch_size] for start in range(0, len(custom_fields), batch_size)]
+        # the salesforce client is synchronous, so send the composite requests from a thread pool
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            batch_errors = list(executor.map(partial(self._create_batch, delay=delay), batches))
+        
+        results = {}
+        for batch, errors in zip(batches, batch_errors):
+            for custom_field in batch:
+                full_name = custom_field['FullName']
+                results[full_name] = errors.get(full_name)
+                if full_name in errors:
+                    logger.debug("  ✗ Exception creating %s: %s", full_name, errors[full_name])
+                else:
+                    logger.debug("  ✓ Created field: %s", full_name)
+                    self._add_to_cache(full_name)
         
-        try:
-            self.mdapi.CustomField.create(custom_field)
-            print(f"  ✓ Created text field: {field_name}")
-            return {'success': True, 'field': field_name}  
-                
-        except Exception as e:
-            print(f"  ✗ Exception creating {field_name}: {str(e)}")
-            return {'success': False, 'field': field_name, 'error': str(e)}
+        return results
     
-    def create_checkbox_field(self, object_name, field_name, label, 
-                             default_value=False, required=False, description=None):
-        """Create a checkbox custom field"""
-        
-        full_name = f"{object_name}.{field_name}"
-        
-        if self.check_field_exists(object_name, field_name):
-            print(f"  ⊗ Field {field_name} already exists, skipping...")
-            return {'success': False, 'message': 'Field already exists'}
-        
-        custom_field = self.mdapi.CustomField(
-            fullName = full_name,
-            label = label,
-            type = self.mdapi.FieldType("Checkbox"),
-            required = required,
-            defaultValue = default_value,
-            deploymentStatus = self.mdapi.DeploymentStatus("Deployed"),
-            sharingModel = self.mdapi.SharingModel("Read")
-        )
-        
-        if description:
-            custom_field['description'] = description
-        
-        try:
-            self.mdapi.CustomField.create(custom_field)
-            print(f"  ✓ Created text field: {field_name}")
-            return {'success': True, 'field': field_name}  
-                
-        except Exception as e:
-            print(f"  ✗ Exception creating {field_name}: {str(e)}")
-            return {'success': False, 'field': field_name, 'error': str(e)}
+    def _add_to_cache(self, full_name):
+        """Record a created field in the cache, if its object has been queried"""
+        object_name, field_name = full_name.split('.', 1)
+        with field_cache_lock:
+            if object_name in self._field_cache:
+                self._field_cache[object_name].add(field_name)
     
-    def create_date_field(self, object_name, field_name, label, 
-                         required=False, description=None):
-        """Create a date custom field"""
-        
-        full_name = f"{object_name}.{field_name}"
-        
-        if self.check_field_exists(object_name, field_name):
-            print(f"  ⊗ Field {field_name} already exists, skipping...")
-            return {'success': False, 'message': 'Field already exists'}
-        
-        custom_field = self.mdapi.CustomField(
-            fullName = full_name,
-            label = label,
-            type = self.mdapi.FieldType("Date"),
-            required = required,
-            deploymentStatus = self.mdapi.DeploymentStatus("Deployed"),
-            sharingModel = self.mdapi.SharingModel("Read")
-        )
-        
-        if description:
-            custom_field['description'] = description
-        
+    def _create_batch(self, batch, delay):
+        """Send one composite request, returning FullName -> error message for the fields that failed"""
+        url = f'/services/data/v{self.sf.sf_version}/tooling/sobjects/CustomField'
+        payload = {
+            'allOrNone': False,
+            'compositeRequest': [
+                {'method': 'POST', 'url': url, 'referenceId': f'field{index}', 'body': custom_field}
+                for index, custom_field in enumerate(batch)
+            ]
+        }
         try:
-            self.mdapi.CustomField.create(custom_field)
-            print(f"  ✓ Created text field: {field_name}")
-            return {'success': True, 'field': field_name}   
-                
+            response = retry_with_backoff(self._tooling, 'composite', 'POST', payload, max_delay=delay)
         except Exception as e:
-            print(f"  ✗ Exception creating {field_name}: {str(e)}")
-            return {'success': False, 'field': field_name, 'error': str(e)}
+            return {custom_field['FullName']: str(e) for custom_field in batch}
+        
+        errors = {}
+        for subresponse in response['compositeResponse']:
+            if subresponse['httpStatusCode'] >= 300:
+                full_name = batch[int(subresponse['referenceId'][len('field'):])]['FullName']
+                errors[full_name] = self._extract_error(subresponse['body'])
+        return errors
     
-    # def create_currency_field(self, object_name, field_name, label, precision=18, 
-    #                          scale=10, required=False, description=None):
-    #     """Create a currency custom field"""
-        
-    #     full_name = f"{object_name}.{field_name}"
-        
-    #     if self.check_field_exists(object_name, field_name):
-    #         print(f"  ⊗ Field {field_name} already exists, skipping...")
-    #         return {'success': False, 'message': 'Field already exists'}
-        
-    #     field_metadata = {
-    #         'fullName': full_name,
-    #         'label': label,
-    #         'type': 'Currency',
-    #         'precision': precision,
-    #         'scale': scale,
-    #         'required': required
-    #     }
-        
-    #     if description:
-    #         field_metadata['description'] = description
-        
-    #     try:
-    #         result = self.metadata_api.create_metadata('CustomField', [field_metadata])
-            
-    #         if result and result[0].get('success'):
-    #             print(f"  ✓ Created currency field: {field_name}")
-    #             return {'success': True, 'field': field_name}
-    #         else:
-    #             error_msg = result[0].get('errors', [{}])[0].get('message', 'Unknown error') if result else 'No response'
-    #             print(f"  ✗ Failed to create {field_name}: {error_msg}")
-    #             return {'success': False, 'field': field_name, 'error': error_msg}
-                
-    #     except Exception as e:
-    #         print(f"  ✗ Exception creating {field_name}: {str(e)}")
-    #         return {'success': False, 'field': field_name, 'error': str(e)}
-
-    # def create_geolocation_field(self, object_name, field_name, label, 
-    #                              display_location_in_decimal=True, 
-    #                              scale=7, required=False, description=None):
-    #     """
-    #     Create a geolocation custom field for latitude/longitude
-        
-    #     This creates a compound field with automatic Latitude and Longitude components.
-    #     Access pattern in Salesforce:
-    #     - Latitude: Field_Name__Latitude__s
-    #     - Longitude: Field_Name__Longitude__s
-    #     """
-        
-    #     full_name = f"{object_name}.{field_name}"
-        
-    #     if self.check_field_exists(object_name, field_name):
-    #         print(f"  ⊗ Field {field_name} already exists, skipping...")
-    #         return {'success': False, 'message': 'Field already exists'}
+    @staticmethod
+    def _extract_error(body):
+        """Format the errors of a failed composite subrequest as "(code, message), ..." """
+        if not body:
+            return 'No response'
+        return ', '.join(f"({error.get('errorCode', 'UNKNOWN')}, {error.get('message', 'Unknown error')})" for error in body)
+
+
+@lru_cache(maxsize=1)
+def load_fields_metadata(path='data/metadata.json'):
+    """
+    Read the csv column -> field type map, once per process
+    
+    Args:
+        path: Path to the metadata json file
         
-    #     field_metadata = {
-    #         'fullName': full_name,
-    #         'label': label,
-    #         'type': 'Location',
-    #         'displayLocationInDecimal': display_location_in_decimal,
-    #         'scale': scale,
-    #         'required': required
-    #     }
+    Returns:
+        dict: Column name -> field type (e.g., 'text')
+    """
+    with open(path, 'rb') as file:
+        return orjson.loads(file.read())['columns']['fields']
+
+
+@lru_cache(maxsize=None)
+def shorten_field_name(name, max_len=25, hard_cap=MAX_FIELD_NAME_LENGTH):
+    """
+    Turn a csv column name into a field name salesforce accepts
+    
+    Args:
+        name: Column name in the provider info csv
+        max_len: Length after which words are abbreviated to their first letter
+        hard_cap: Longest name salesforce allows, without the __c suffix
         
-    #     if description:
-    #         field_metadata['description'] = description
+    Returns:
+        str: Field name, words joined with underscores
+    """
+    # remove unsupported characters 
+    field = INVALID_FIELD_CHARS.sub(' ', name)
+    if len(field) > max_len:
+        words = field.split()
+        parts = [words[0]]
+        length = len(words[0])
+        for word in words[1:]:
+            # a word that would take the name past max_len is abbreviated to its first letter
+            if length + len(word) > max_len:
+                # if that goes past the hard cap, keep at current lenght
+                if length + 2 > hard_cap:
+                    break
+                word = word[0].upper()
+            parts.append(word)
+            length += len(word) + 1
+        field = '_'.join(parts)
+
+    # names short enough to keep every word still have their spaces
+    return field.replace(' ', '_')
+
+
+def column_field_spec(column, field_type):
+    """
+    Get the field spec for a csv column, deriving the field name from the column name
+    
+    Args:
+        column: Column name in the provider info csv
+        field_type: Key of FIELD_TYPES (e.g., 'text')
         
-    #     try:
-    #         result = self.metadata_api.create_metadata('CustomField', [field_metadata])
-            
-    #         if result and result[0].get('success'):
-    #             print(f"  ✓ Created geolocation field: {field_name}")
-    #             print(f"    → Access latitude as: {field_name.replace('__c', '__Latitude__s')}")
-    #             print(f"    → Access longitude as: {field_name.replace('__c', '__Longitude__s')}")
-    #             return {'success': True, 'field': field_name}
-    #         else:
-    #             error_msg = result[0].get('errors', [{}])[0].get('message', 'Unknown error') if result else 'No response'
-    #             print(f"  ✗ Failed to create {field_name}: {error_msg}")
-    #             return {'success': False, 'field': field_name, 'error': error_msg}
-                
-    #     except Exception as e:
-    #         print(f"  ✗ Exception creating {field_name}: {str(e)}")
-    #         return {'success': False, 'field': field_name, 'error': str(e)}
+    Returns:
+        FieldSpec: the field to create for the column
+    """
+    if column in SPECIAL_FIELDS:
+        return FieldSpec.from_config(field_type, SPECIAL_FIELDS[column])
+    
+    field = shorten_field_name(column)
+    return FieldSpec(field_type, 'Account', f'{field}__c', field)
 
 
 def create_healthcare_fields(sf, delay=2):
@@ -279,7 +473,7 @@ def create_healthcare_fields(sf, delay=2):
     
     Args:
         sf: Salesforce connection
-        delay: Seconds to wait between field creations
+        delay: Longest wait in seconds before retrying a throttled call
         
     Returns:
         dict: Summary of created and failed fields
@@ -293,141 +487,113 @@ def create_healthcare_fields(sf, delay=2):
         'skipped': []
     }
     
-    print("Creating Healthcare Facility Custom Fields on Account Object")
-    
-    fields_to_create = []
-    salesforce_inbuilt_fields = {
-        'Provider Name': 'Name',
-        'Provider Address': 'BillingStreet',
-        'City/Town': 'BillingCity',
-        'State': 'BillingState',
-        'ZIP Code': 'BillingPostalCode',
-        'Telephone Number': 'Phone',
-        'Provider Type': 'Type',
-        'Ownership Type': 'Industry',
-    }
-    with open('data/metadata.json') as file:
-        metadata = json.loads(file.read()) 
-        fields_metadata = metadata['columns']['fields']
-
-        for field in fields_metadata:
-            field_type = fields_metadata[field]
-            if field in salesforce_inbuilt_fields:
-                continue
-            elif field == 'CMS Certification Number (CCN)' :
-                fields_to_create += [
-                    (field_type,
-                    {
-                        'object_name': 'Account',
-                        'field_name': 'CCN__c',
-                        'label': 'CMS Certification Number',
-                        'length': 50,
-                        'unique': True,
-                        'external_id': True,
-                        'description': 'CMS Certification Number (CCN) - unique identifier'
-                    }
-                    )
-                ]
-            elif field == 'County/Parish':
-                fields_to_create += [
-                    (field_type,{
-                        "object_name":"Account",
-                        "field_name":"County__c",
-                        "label":"County"
-                    })
-                ]
+    logger.info("Creating Healthcare Facility Custom Fields on Account Object")
+    
+    fields_to_create = [
+        column_field_spec(column, field_type)
+        for column, field_type in load_fields_metadata().items()
+        if column not in SALESFORCE_INBUILT_FIELDS
+    ]
+    
+    # Build and validate the metadata for every field before making any api call
+    built_fields = []
+    for spec in fields_to_create:
+        try:
+            built_fields.append((spec, spec.to_metadata()))
+        except (ValueError, TypeError) as e:
+            results['failed'].append({'field': spec.field_name, 'error': str(e)})
+    
+    # Only create the fields that do not exist yet, filtering in one pass against each object's fields
+    existing = {object_name: field_manager.existing_fields(object_name) for object_name in {spec.object_name for spec, _ in built_fields}}
+    results['skipped'] = [spec.field_name for spec, _ in built_fields if spec.field_name in existing[spec.object_name]]
+    custom_fields = [custom_field for spec, custom_field in built_fields if spec.field_name not in existing[spec.object_name]]
+    
+    # Create them in as few requests as possible, on a re-run there is usually nothing left to create
+    if custom_fields:
+        logger.info("Creating %d fields...", len(custom_fields))
+        for full_name, error in field_manager.create_fields_batch(custom_fields, delay=delay).items():
+            field_name = full_name.split('.', 1)[1]
+            if error is None:
+                results['created'].append(field_name)
             else:
-                # remove unsupported characters 
-                field = re.sub(r'[^A-Za-z0-9_]', ' ', field)
-                if len(field) > 25:
-                    words = field.split()
-                    field = words[0]
-                    for word in words[1:]:
-                        abbreviate = False
-                        if len(field) + len(word) > 25 or abbreviate==True:
-                            abbreviate = True
-                            field += f'_{word[0].upper()}'
-                            # 40 characters is the limit for salesforce
-                            # if greater than 40, keep at current lenght
-                            if len(field) > 40:
-                                field = field[:-2]
-                                break
-                        else: field += f'_{word}'
-
-                try: field = field.replace(' ', '_')
-                except: pass
-                fields_to_create += [
-                    (field_type,
-                    {
-                        'object_name': 'Account',
-                        'field_name': f'{field}__c',
-                        'label': f'{field}'
-                    }
-                    )
-                ]
-                
-
-    total_fields = len(fields_to_create)
-    
-    # Create each field
-    for index, (field_type, field_config) in enumerate(fields_to_create, 1):
-        print(f"[{index}/{total_fields}] Creating {field_config['field_name']}...")
-        
-        # Call appropriate method based on field type
-        if field_type == 'text':
-            result = field_manager.create_text_field(**field_config)
-        elif field_type == 'num':
-            result = field_manager.create_number_field(**field_config)
-        elif field_type == 'checkbox':
-            result = field_manager.create_checkbox_field(**field_config)
-        elif field_type == 'date':
-            result = field_manager.create_date_field(**field_config)
-        else:
-            result = {'success': False, 'error': 'Unknown field type'}
-        
-        # Track results
-        if result.get('success'):
-            results['created'].append(field_config['field_name'])
-        elif result.get('message') == 'Field already exists':
-            results['skipped'].append(field_config['field_name'])
-        else:
-            results['failed'].append({
-                'field': field_config['field_name'],
-                'error': result.get('error', 'Unknown error')
-            })
-        
-        # Delay between field creations
-        if index < total_fields:
-            time.sleep(delay)
+                results['failed'].append({'field': field_name, 'error': error})
+    
+    # one line per field, written out as a single record
+    summary = [f"Successfully created {len(results['created'])} fields :"]
+    summary += [f"  ✓ {field}" for field in results['created']]
+    summary += [f"{len(results['skipped'])} fields already existed and hence skipped :"]
+    summary += [f"  ⊗ {field}" for field in results['skipped']]
+    summary += [f"{len(results['failed'])} fields failed:"]
+    summary += [f"  ✗ {failure['field']}: {failure['error']}" for failure in results['failed']]
+    logger.info('\n'.join(summary))
     
-    print(f"Successfully created {len(results['created'])} fields : {results['created']} ")
-    print(f"{len(results['skipped'])} fields already existed and hence skipped : {results['skipped']}")
-    print(f"{len(results['failed'])} fields failed: {results['failed']}")
+    # write out whatever progress is still buffered
+    for handler in logging.getLogger().handlers:
+        handler.flush()
     
     return results
 
 
+def connect_to_salesforce(consumer_key, consumer_secret, domain, cache_path=SESSION_CACHE, ttl=SESSION_TTL):
+    """
+    Connect to Salesforce, reusing the session of a previous run while it is still valid
+    
+    Args:
+        consumer_key: Connected app consumer key
+        consumer_secret: Connected app consumer secret
+        domain: Salesforce domain
+        cache_path: File the session id and instance are kept in between runs, with the domain and key they belong to
+        ttl: Age in seconds after which a cached session is not tried
+        
+    Returns:
+        simple_salesforce.Salesforce instance
+    """
+    # imported here so the field config can be used without loading simple_salesforce
+    from simple_salesforce import Salesforce, SalesforceExpiredSession
+    
+    try:
+        if time.time() - os.path.getmtime(cache_path) < ttl:
+            with open(cache_path, 'rb') as file:
+                cached = orjson.loads(file.read())
+            # a session of another org or connected app must not be reused
+            if (cached.get('domain'), cached.get('consumer_key')) == (domain, consumer_key):
+                sf = Salesforce(instance=cached['instance'], session_id=cached['session_id'])
+                # cheap call to make sure the session has not been expired or revoked
+                sf.limits()
+                return sf
+    except (OSError, KeyError, ValueError, SalesforceExpiredSession):
+        pass
+    
+    sf = Salesforce(consumer_key=consumer_key, consumer_secret=consumer_secret, domain=domain)
+    # the session id is a credential, keep it readable by the owner only
+    with open(os.open(cache_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as file:
+        file.write(orjson.dumps({'domain': domain, 'consumer_key': consumer_key,
+                                 'instance': sf.sf_instance, 'session_id': sf.session_id}))
+    return sf
+
+
 def main():
     """Main execution function"""
     
-    print("Healthcare Facility Custom Field Creator")
-    print("Using simple-salesforce-metadata2\n")
+    # buffer progress messages and write them out 100 at a time
+    # per field progress is only shown with -v, the summary lists every field anyway
+    level = logging.DEBUG if '-v' in sys.argv[1:] else logging.INFO
+    logging.basicConfig(level=level, handlers=[MemoryHandler(capacity=100, target=logging.StreamHandler(sys.stdout))])
+    
+    logger.info("Healthcare Facility Custom Field Creator")
+    logger.info("Using the Salesforce Tooling API\n")
     
+    # fail straight away, naming the missing variable, rather than on a failed login
     load_dotenv()
-    CONSUMER_KEY = os.getenv('CONSUMER_KEY')
-    CONSUMER_SECRET = os.getenv('CONSUMER_SECRET')
-    DOMAIN = os.getenv('DOMAIN')
+    CONSUMER_KEY = os.environ['CONSUMER_KEY']
+    CONSUMER_SECRET = os.environ['CONSUMER_SECRET']
+    DOMAIN = os.environ['DOMAIN']
     
     try:
         # Connect to Salesforce
-        print("Connecting to Salesforce...")
-        sf = Salesforce(
-            consumer_key=CONSUMER_KEY,
-            consumer_secret=CONSUMER_SECRET,
-            domain=DOMAIN
-        )
-        sf.mdapi
-        print("✓ Connected successfully\n")
+        logger.info("Connecting to Salesforce...")
+        sf = connect_to_salesforce(CONSUMER_KEY, CONSUMER_SECRET, DOMAIN)
+        logger.info("✓ Connected successfully\n")
         
         
         # Create all healthcare fields
@@ -437,8 +603,7 @@ def main():
         return results
         
     except Exception as e:
-        print(f"\n✗ Error: {str(e)}")
-        print(traceback.format_exc())
+        logger.exception("\n✗ Error: %s", e)
         return None
 
 
@@ -446,7 +611,7 @@ if __name__ == "__main__":
     results = main()
     
     if results:
-        print("\n✓ Field creation process completed!")
-        print(f"Total created: {len(results['created'])}")
+        logger.info("\n✓ Field creation process completed!")
+        logger.info("Total created: %d", len(results['created']))
     else:
-        print("\n✗ Field creation process failed!")
\ No newline at end of file
+        logger.error("\n✗ Field creation process failed!")
\ No newline at end of file
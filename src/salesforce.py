@@ -12,9 +12,28 @@ from dotenv import load_dotenv
 """
 
 
+# names per existing account query, keeps each soql statement well under its length limit
+QUERY_CHUNK_SIZE = 200
+
+# connection shared by every call in this process, salesforce renews its session as needed
+sf_client = None
+
+
+def to_records(df):
+    """ Converts a dataframe to bulk api records.
+        The bulk api rejects NaN when serialising, so missing values are sent as null.
+    """
+    return df.astype(object).where(df.notna(), None).to_dict('records')
+
+
 def connect_to_salesforce():
     """ Established a connection to salesforce and returns the salesforce object.
+        The connection is made once and reused by later calls, see invalidate_sf.
     """
+    global sf_client
+    if sf_client is not None:
+        return sf_client
+
     try:
         load_dotenv()
 
@@ -37,63 +56,121 @@ def connect_to_salesforce():
         consumer_key = os.getenv('CONSUMER_KEY')
         consumer_secret = os.getenv('CONSUMER_SECRET')
         domain = 'dwu00000ymz9b2af-dev-ed.develop.my'
-        sf = Salesforce(consumer_key=consumer_key, consumer_secret=consumer_secret, domain=domain)
-        return sf
+        sf_client = Salesforce(consumer_key=consumer_key, consumer_secret=consumer_secret, domain=domain)
+        return sf_client
     
     except Exception as e:
         print(f"✗ Failed to connect to Salesforce: {e}")
         return None
 
 
+def invalidate_sf():
+    """ Drops the shared connection, so the next connect_to_salesforce call logs in again
+        e.g after an INVALID_SESSION_ID error.
+    """
+    global sf_client
+    sf_client = None
+
 
-def create_accounts_batch(accounts:pd.DataFrame):
-    """Create multiple accounts, skipping duplicates
+def upsert_accounts(sf:Salesforce, accounts:pd.DataFrame, external_id_field:str, include_existing:bool=False):
+    """Upsert accounts with the bulk api, matching existing accounts on an external id field.
+        Salesforce does the duplicate check, so no query is needed beforehand.
 
         arguments:
-            accounts: a dataframe containing all accounts needed to be created.
+            sf: the salesforce connection
+            accounts: a dataframe with a Name column and the external id column
+            external_id_field: api name of the external id field, e.g CCN__c
+            include_existing: also return the accounts that already existed, with created False
 
     """
-    try:
-        sf = connect_to_salesforce()
-        account_names = accounts['Name']
-        # Step 1: Query all existing accounts at once
-        names_str = "', '".join([name.replace("'", "\\'") for name in account_names])
-        query = f"SELECT Id, Name FROM Account WHERE Name IN ('{names_str}')"
-        # query = f"SELECT Id, Name FROM Account WHERE CCN__c IN ('{}')"
-        existing = sf.query(query)
-        
-        # existing_ccns = {record['CCN_c'] for record in existing['records']}
-        existing_names = {record['Name'] for record in existing['records']}
-        
-        # Step 3: Create new accounts
-        results = []
-        for index, row in accounts.iterrows():
-            name = row['Name']
-            if name in existing_names: continue
-            new_account = sf.Account.create({
-                'Name': name
-                
+    # rows without an external id cannot be matched, report them instead of sending them
+    missing = accounts[external_id_field].isna()
+    for name in accounts.loc[missing, 'Name']:
+        print(f"Skipped {name}: no {external_id_field}")
+    accounts = accounts.loc[~missing, ['Name', external_id_field]]
+
+    records = to_records(accounts)
+    upserted = sf.bulk.Account.upsert(records, external_id_field, batch_size=10000) if records else []
+
+    results = []
+    for record, result in zip(records, upserted):
+        if not result['success']:
+            print(f"Failed to upsert {record['Name']}: {result['errors']}")
+        elif result['created'] or include_existing:
+            results.append({
+                'Id': result['id'],
+                'Name': record['Name'],
+                'created': result['created']
+            })
+            print(f"{'Created' if result['created'] else 'Already exists'}: {record['Name']}")
 
+    return results
 
 
+def create_accounts_batch(accounts:pd.DataFrame, sf:Salesforce=None, external_id_field:str='CCN__c', include_existing:bool=False):
+    """Create multiple accounts, skipping duplicates.
+        Rows repeating an earlier key are dropped, only the first one is created. The key is the
+        external id when upserting, since distinct facilities can share a name, otherwise the Name.
 
+        arguments:
+            accounts: a dataframe containing all accounts needed to be created.
+            sf: the salesforce connection, defaults to the shared one from connect_to_salesforce
+            external_id_field: when the dataframe has this column, accounts are upserted on it instead,
+                see upsert_accounts. Existing accounts then get their Name updated.
+            include_existing: also return the accounts that already existed, with created False
 
-            })
-            results.append({
-                'Id': new_account['id'],
-                'Name': name,
-                'created': True
-            })
-            print(f"Created: {name}")
+    """
+    try:
+        if sf is None:
+            sf = connect_to_salesforce()
+        if external_id_field in accounts.columns:
+            # keep one row per external id, rows without one are left for upsert_accounts to report
+            repeated = accounts[external_id_field].duplicated(keep='first') & accounts[external_id_field].notna()
+            return upsert_accounts(sf, accounts[~repeated].reset_index(drop=True), external_id_field, include_existing)
+
+        # raw feeds repeat names, keep one row per name so they are queried and created once
+        accounts = accounts.drop_duplicates(subset='Name', keep='first').reset_index(drop=True)
+
+        account_names = accounts['Name'].dropna().tolist()
+        # Step 1: Query existing accounts, 200 names per query to stay well inside the soql length limit
+        existing_records = []
+        for start in range(0, len(account_names), QUERY_CHUNK_SIZE):
+            chunk = account_names[start:start + QUERY_CHUNK_SIZE]
+            # escape backslashes before quotes, so each name stays one soql string literal
+            names_str = "', '".join(name.replace('\\', r'\\').replace("'", r"\'") for name in chunk)
+            query = f"SELECT Id, Name FROM Account WHERE Name IN ('{names_str}')"
+            # query = f"SELECT Id, Name FROM Account WHERE CCN__c IN ('{}')"
+            existing_records += sf.query_all(query)['records']
         
-        # Add existing accounts to results
-        for record in existing['records']:
-            results.append({
-                'Id': record['Id'],
-                'Name': record['Name'],
-                'created': False
-            })
-            print(f"Already exists: {record['Name']}")
+        # existing_ccns = {record['CCN_c'] for record in existing_records}
+        existing_names = {record['Name'] for record in existing_records}
+        
+        # Step 3: Create new accounts with the bulk api, up to 10,000 records per request
+        new_accounts = accounts.loc[~accounts['Name'].isin(existing_names), ['Name']]
+        records = to_records(new_accounts)
+        inserted = sf.bulk.Account.insert(records, batch_size=10000) if records else []
+
+        results = []
+        for record, result in zip(records, inserted):
+            if result['success']:
+                results.append({
+                    'Id': result['id'],
+                    'Name': record['Name'],
+                    'created': True
+                })
+                print(f"Created: {record['Name']}")
+            else:
+                print(f"Failed to create {record['Name']}: {result['errors']}")
+        
+        # Add existing accounts to results, only when the caller asks for them
+        if include_existing:
+            for record in existing_records:
+                results.append({
+                    'Id': record['Id'],
+                    'Name': record['Name'],
+                    'created': False
+                })
+                print(f"Already exists: {record['Name']}")
         
         return results
     except SalesforceMalformedRequest as e:
@@ -0,0 +1,17 @@
+def is_transient(error):
+    """True for errors that are safe to retry: throttling responses and connections that could not be opened.
+    A connection that dropped after the request was sent, or a read timeout, is not retried
+    since the request may already have been applied.
+    """
+    # imported here so the field config can be used without loading requests
+    from requests.exceptions import ConnectionError, ConnectTimeout
+    from urllib3.exceptions import NewConnectionError
+
+    if isinstance(error, ConnectTimeout):
+        return True
+    if isinstance(error, ConnectionError):
+        # requests wraps the urllib3 error, whose reason says why the connection failed
+        reason = getattr(error.args[0], 'reason', None) if error.args else None
+        return isinstance(reason, NewConnectionError)
+    # the API request limit comes back as a 403 (SalesforceRefusedRequest)
+    return getattr(error, 'status', None) in (429, 503) or 'REQUEST_LIMIT_EXCEEDED' in str(error)